@@ -3,8 +3,10 @@
 #Description: A file for the UI of stegprotocolv4.py
 
 #Importing necessary libraries
-import stegprotocolv4 as Sv4
 import customtkinter as customtk
+import tkinter.messagebox as tkMessageBox
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
 
 #Setting the theme
 customtk.set_appearance_mode("System")
@@ -15,34 +17,112 @@ class StegGUI(customtk.CTk):
         super().__init__()
 
         self.title("Stegcore")
+        #One long-lived worker, jobs queue behind each other instead of spawning a thread per click
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stegcore-worker")
+        #stegprotocolv4 pulls in Pillow, NumPy and the crypto backends, so import it
+        #on the worker while the window comes up instead of before it
+        self.protocol_import = self.worker.submit(import_module, "stegprotocolv4")
         self.iconbitmap(r"Stag.ico") #Change to absolute path when converting to exe
         frame = customtk.CTkFrame(self)
         frame.pack(pady=20, padx=20, fill='both', expand=True)
 
+        #One font object shared by both buttons instead of a tuple parsed per widget
+        self.button_font = customtk.CTkFont(family='Consolas', size=19)
+
         #The Encoding button
         self.encode_button = customtk.CTkButton(
             master=frame, command=self.encoding_event,
             text='Embed',
-            font=('Consolas',19))
+            font=self.button_font)
         self.encode_button.pack(padx=100, pady=30)
 
         #The decoding button
         self.decode_button = customtk.CTkButton(
             master=frame, command=self.decoding_event,
             text='Extract',
-            font=('Consolas', 19))
+            font=self.button_font)
         self.decode_button.pack(padx=100, pady=50)
 
 
     def encoding_event(self):
-        while Sv4.encoding():
-            if Sv4.encoding() == False:
-                break
+        #Let the disabled buttons paint before the first dialog opens
+        self.set_busy(True)
+        self.after(1, self.start_encoding)
+
+    def start_encoding(self):
+        #Dialogs stay on the Tk thread, the crypto and LSB work does not
+        stegprotocol = self.load_protocol_module()
+        if stegprotocol is None:
+            return
+        job = self.collect_job(stegprotocol.encoding)
+        if job is not None:
+            self.run_in_background(job, 'Embedding complete')
+
+    def run_in_background(self, job, done_message):
+        #The worker never touches Tk itself, results go back through after()
+        def worker():
+            try:
+                job()
+            except self.protocol_import.result().StegError as error:
+                self.after(0, self.finish_working, False, str(error))
+            except Exception as error:
+                #A future would swallow this silently and leave the buttons disabled
+                self.after(0, self.finish_working, False, f"Unexpected error: {error}")
+            else:
+                self.after(0, self.finish_working, True, done_message)
+        self.worker.submit(worker)
+
+    #Runs back on the Tk thread once the worker is done
+    def finish_working(self, success, message):
+        self.set_busy(False)
+        if success:
+            tkMessageBox.showinfo(message=message)
+        else:
+            tkMessageBox.showerror(message=message)
     
     def decoding_event(self):
-        while Sv4.decoding():
-            if Sv4.decoding() == False:
-                break
+        self.set_busy(True)
+        self.after(1, self.start_decoding)
+
+    def start_decoding(self):
+        #Same split as embedding, recovery and decryption run on the worker
+        stegprotocol = self.load_protocol_module()
+        if stegprotocol is None:
+            return
+        job = self.collect_job(stegprotocol.decoding)
+        if job is not None:
+            self.run_in_background(job, 'Extraction complete')
+
+    #The protocol module, waiting on the background import if a click beats it.
+    #A failed import is reported here and gives None, so the buttons come back.
+    #Not named protocol(): that would shadow Wm.protocol, which Tk.__init__ calls.
+    def load_protocol_module(self):
+        try:
+            return self.protocol_import.result()
+        except Exception as error:
+            #Not just ImportError, a module can fail to load in plenty of other ways
+            self.set_busy(False)
+            tkMessageBox.showerror(message=f"Unable to load Stegcore: {error}")
+            return None
+
+    #Runs the dialog phase on the Tk thread. A cancelled dialog or anything it raises
+    #(an odd dialog return, a Tcl error) gives None with the buttons back on.
+    def collect_job(self, dialogs):
+        try:
+            job = dialogs()
+        except Exception as error:
+            self.set_busy(False)
+            tkMessageBox.showerror(message=f"Unexpected error: {error}")
+            return None
+        if job is None:
+            self.set_busy(False)
+        return job
+
+    #Blocking both buttons so a second click can't start overlapping work
+    def set_busy(self, busy):
+        state = 'disabled' if busy else 'normal'
+        self.encode_button.configure(state=state)
+        self.decode_button.configure(state=state)
 
 if __name__ == "__main__":
     app = StegGUI()
@@ -7,12 +7,153 @@ from tkinter import filedialog
 import tkinter.messagebox as tkMessageBox
 from pathlib import Path
 from stego_lsb import LSBSteg
+from PIL import Image
 from ascon._ascon import ascon_encrypt, get_random_bytes, ascon_decrypt
 import customtkinter as customtk
-from os import remove
+from os import remove, replace, fstat, fsync
+from os.path import basename, dirname
+from tempfile import mkstemp
+from functools import partial
+import struct
+
+#Accepted file extensions, matched against the lower-cased suffix
+TEXT_EXTS = frozenset({".txt"})
+IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg"})
+STEGO_IMAGE_EXTS = frozenset({".png"})
+KEY_FILE_EXTS = frozenset({".bin"})
+
+#File dialog filters, built once instead of per dialog
+TEXT_FILETYPES = (("Text files", "*.txt"),)
+IMAGE_FILETYPES = (("Image files", ("*.png", "*.jpg", "*.jpeg")),)
+STEGO_IMAGE_FILETYPES = (("Image files", "*.png"),)
+KEY_FILETYPES = (("Binary files", "*.bin"),)
+
+#AES-GCM through OpenSSL is far faster than the pure Python Ascon, use it when available
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+
+#The variant used for new embeddings. Key files record theirs, untagged ones are Ascon-128
+DEFAULT_VARIANT = "AES-128-GCM" if AESGCM is not None else "Ascon-128"
+
+#Encrypting with whichever variant was chosen
+def aead_encrypt(key, nonce, associated_data, plaintext, variant):
+    if variant == "AES-128-GCM":
+        #GCM takes a 96-bit nonce
+        return AESGCM(key).encrypt(nonce[:12], plaintext, associated_data)
+    return ascon_encrypt(key, nonce, associated_data, plaintext, variant)
+
+#Decrypting with the variant recorded in the key file (None on a failed tag check, like Ascon)
+def aead_decrypt(key, nonce, associated_data, ciphertext, variant):
+    #Too short to even hold the 16-byte tag. Ascon would trip an assert, so fail both the same way
+    if len(ciphertext) < 16:
+        return None
+    if variant == "AES-128-GCM":
+        if AESGCM is None:
+            raise RuntimeError("AES-128-GCM key file requires the 'cryptography' package")
+        try:
+            return AESGCM(key).decrypt(nonce[:12], ciphertext, associated_data)
+        except InvalidTag:
+            return None
+    return ascon_decrypt(key, nonce, associated_data, ciphertext, variant)
+
+#Key file layout: magic, version, then the length of each field followed by the fields
+KEY_FILE_MAGIC = b'SGK'
+KEY_FILE_VERSION = 1
+KEY_FILE_HEADER = struct.Struct('<3sBHHHH')
+#Separator used by key files from before the header was introduced,
+#laid out as key, nonce and info type each followed by the delimiter
+LEGACY_DELIMITER = b'ElementMerc'
+
+#Writing to a unique temp file next to the target, syncing it to disk and swapping it in,
+#so the target is either the old file or the complete new one, never a partial write
+def write_atomically(path, data):
+    descriptor, part = mkstemp(
+        dir=dirname(path) or '.', prefix=f".{basename(path)}.", suffix='.part')
+    try:
+        with open(descriptor, 'wb') as writer:
+            writer.write(data)
+            writer.flush()
+            fsync(writer.fileno())
+        replace(part, path)
+    except OSError:
+        try:
+            remove(part)
+        except OSError:
+            pass
+        raise
+
+#Writing key, nonce, info type and variant behind a fixed-length header
+def write_key_file(key_file, key, nonce, info_type, variant):
+    fields = [key, nonce, info_type.encode("utf-8"), variant.encode("utf-8")]
+    header = KEY_FILE_HEADER.pack(
+        KEY_FILE_MAGIC, KEY_FILE_VERSION, *[len(field) for field in fields])
+    write_atomically(key_file, header + b''.join(fields))
+
+#Variants a key file may name, anything else is rejected up front
+KNOWN_VARIANTS = frozenset({"AES-128-GCM", "Ascon-128"})
+
+#Reading a key file back as (key, nonce, info_type, variant). The key and nonce
+#come back as bytearrays so the caller can wipe the key when done.
+#Returns None instead of raising when the file is not a valid key file.
+def read_key_file(authentication):
+    with open(authentication, 'rb') as reader:
+        data = bytearray(fstat(reader.fileno()).st_size)
+        del data[reader.readinto(data):]
+    try:
+        return parse_key_file(data)
+    finally:
+        wipe(data)
+
+def parse_key_file(data):
+    fields = None
+    if data[:len(KEY_FILE_MAGIC)] == KEY_FILE_MAGIC and len(data) >= KEY_FILE_HEADER.size:
+        _, version, *lengths = KEY_FILE_HEADER.unpack_from(data, 0)
+        if version == KEY_FILE_VERSION and len(data) == KEY_FILE_HEADER.size + sum(lengths):
+            fields = []
+            offset = KEY_FILE_HEADER.size
+            for length in lengths:
+                fields.append(data[offset:offset + length])
+                offset += length
+            key, nonce, info_type, variant = fields
+            variant = bytes(variant)
+
+    if fields is None:
+        #Older key files are delimiter separated, walk the delimiters instead of splitting everything
+        #All three delimiters are found before anything is copied, so a bad file leaves no key behind
+        bounds = []
+        start = 0
+        for _ in range(3):
+            end = data.find(LEGACY_DELIMITER, start)
+            if end == -1:
+                return None
+            bounds.append((start, end))
+            start = end + len(LEGACY_DELIMITER)
+        with memoryview(data) as view:
+            key, nonce, info_type = [bytearray(view[start:end]) for start, end in bounds]
+        #Delimited key files predate the variant tag and are always Ascon-128
+        variant = b"Ascon-128"
+
+    #Checking the fields here rather than letting the crypto trip over them later
+    variant = variant.decode("utf-8", errors="replace")
+    if len(key) != 16 or len(nonce) != 16 or variant not in KNOWN_VARIANTS:
+        wipe(key)
+        return None
+    return key, nonce, info_type.decode("utf-8", errors="replace"), variant
+
+#Raised with a message that can be shown to the user as is
+class StegError(Exception):
+    pass
+
+#Overwriting a bytearray holding secrets once it is no longer needed.
+#Best effort only: copies made inside the crypto and imaging libraries are out of reach.
+def wipe(buffer):
+    buffer[:] = bytes(len(buffer))
 
 #The encryption module
-def embed_text_in_image(text, image, info_type):
+def embed_text_in_image(text, image, info_type, passphrase, output_image, key_file):
     '''
     Breakdown of the function:
     1. Read the contents of the text file
@@ -21,171 +162,170 @@ def embed_text_in_image(text, image, info_type):
     4. Encrypt the information into a ciphertext
     5. Hide the information in the image and save
     6. Export the key and nonce to a file for decryption
+
+    Every path is collected up front by encoding(), so nothing here opens a
+    dialog and the whole function can run off the Tk thread. Failures are
+    raised as StegError.
     '''
-    # Opening the text file and read its contents
-    secret_text = Path(text).read_text(errors='ignore')
+    # Reading the text file as raw bytes into a buffer that can be wiped afterwards
+    try:
+        with open(text, 'rb') as source:
+            plaintext = bytearray(fstat(source.fileno()).st_size)
+            del plaintext[source.readinto(plaintext):]
+    except OSError:
+        raise StegError("Unable to read text file")
 
     #Preparing the components for encryption
     '''
-    variant: The ascon algorithm of string type
+    variant: The AEAD algorithm of string type (AES-128-GCM or Ascon-128)
     associated_data, key, nonce: Various keys of byte type that are used in encryption
     plaintext: The text to be embedded in byte format
     '''
-    variant = "Ascon-128"
-    key   = get_random_bytes(16)
-    nonce = get_random_bytes(16)
-    plaintext = secret_text.encode("utf-8")
-    dialog = customtk.CTkInputDialog(
-        text='Input a passphrase:', 
-        title="Passphrase")
-
-    associated_data = (dialog.get_input()).encode("utf-8")
-    if  associated_data == '':
-        tkMessageBox.showerror(message='Passphrase required')
-        exit()
+    variant = DEFAULT_VARIANT
+    #One 32-byte draw from the CSPRNG, split into key and nonce
+    key_material = bytearray(get_random_bytes(32))
+    key   = key_material[:16]
+    nonce = bytes(key_material[16:])
+    wipe(key_material)
+    associated_data = passphrase.encode("utf-8")
     
-    #Encrypting the text
     try:
-        ciphertext = ascon_encrypt(
-            key, 
-            nonce, 
-            associated_data, 
-            plaintext, 
-            variant)
-        temp = './temp.bin'
-        Path(temp).write_bytes(ciphertext)
-    except:
-        tkMessageBox.showerror(message="Unable to encrypt text")
-        remove(temp)
-        exit()
+        #Encrypting the text
+        try:
+            ciphertext = aead_encrypt(
+                key, 
+                nonce, 
+                associated_data, 
+                plaintext, 
+                variant)
+        except (ValueError, OverflowError):
+            raise StegError("Unable to encrypt text")
+        #The plaintext is not needed past this point
+        wipe(plaintext)
 
-    try:
-        output_image = filedialog.asksaveasfilename(
-            title = "Save output image as", 
-            defaultextension=".png")
-    except:
-        tkMessageBox.showerror(message="Operation cancelled by user")
-        remove(temp)
+        #Using stegano to hide the ciphertext straight from memory
+        try:
+            cover = Image.open(image)
+        except OSError:
+            raise StegError("Unable to open the selected image")
+        try:
+            steg_image = LSBSteg.hide_message_in_image(cover, ciphertext, 3)
+        except ValueError:
+            raise StegError("Image is too small. Please select a larger image")
+        try:
+            #The LSBs are high-entropy ciphertext, so zlib level 9 costs time without shrinking much
+            steg_image.save(output_image, compress_level=1)
+        except OSError:
+            raise StegError("Unable to save output image")
 
-    #Using stegano to hide the text, and write the unlock codes
-    try:
-        processed = LSBSteg.hide_data(image, temp, output_image, 3, 9)
-        processing_save = True
-    except:
-        tkMessageBox.showerror(
-            message="Image is too small. Please select a larger image")
-        processing_save = False
-
-    #Writing the keys to the kingdom
-    if processing_save == True:
+        #Writing the keys to the kingdom
         try:
-            key_file = filedialog.asksaveasfilename(
-                title = "Save the key as", 
-                defaultextension=".bin")
-            keys_list = [key, nonce, info_type.encode("utf-8")]
-            delimiter = b'ElementMerc'
-            with open(key_file, 'wb') as unlock_info:
-                for every_key in keys_list:
-                    unlock_info.write(every_key + delimiter)
-                unlock_info.close()
-            remove(temp)
-            tkMessageBox.showinfo(message='Embedding complete')
-        except:
-            tkMessageBox.showerror(message='Unable to save key file')
-            remove(temp)
-            remove(processed)
+            write_key_file(key_file, key, nonce, info_type, variant)
+        except OSError:
+            #The image is useless without its key, but failing to remove it must not hide why
+            try:
+                remove(output_image)
+            except OSError:
+                pass
+            raise StegError('Unable to save key file')
+    finally:
+        wipe(plaintext)
+        wipe(key)
     
 #The decryption function
-def extract_text_in_image(image, authentication):
+def extract_text_in_image(image, key, nonce, variant, passphrase, output_text_file):
     '''
     Breakdown of the function
-    1. Take in the image and authentication file
-    2. Convert the authentication to a text file (decode as you go)
-    3. Break down the file to key and nonce
-    4. Extract info from image
-    5. Decrypt using the authentication information
-    6. Save the file
+    1. Take in the image and the unlock codes read from the authentication file
+    2. Extract info from image
+    3. Decrypt using the authentication information
+    4. Save the file
+
+    The authentication file, passphrase and output path are collected up
+    front by decoding(), so this runs off the Tk thread like the embed does.
+    Failures are raised as StegError.
     '''
-    #Getting necessary info
-    delimiter = b'ElementMerc'
-    with open(authentication, "rb") as reader:
-        data = reader.read()
-        data_list = data.split(delimiter)
-    reader.close
-    key = data_list[0]
-    nonce = data_list[1]
-    info_type = data_list[2]
-    variant = "Ascon-128"
-    
-    #Instant decoding
     try:
-        temp_file = './temp.txt'
-        LSBSteg.recover_data(image, temp_file, 3)
-        image_check = True
-    except IndexError:
-        image_check = False
-        tkMessageBox.showerror(message="No information detected in the image")
-        remove(temp_file)
-    
-    if image_check == True:
-        try:
-            temp = Path(temp_file).read_bytes()
-            dialog = customtk.CTkInputDialog(
-                text='Input the passphrase:', 
-                title="Passphrase")
-            associated_data = (dialog.get_input()).encode("utf-8")
-            #Decrypting using the information
-            unencrypted_text = (
-                ascon_decrypt(key, nonce, associated_data, temp, variant)).decode("utf-8")
-            password_check = True
-        except:
-            tkMessageBox.showerror(message="Invalid Password")
-            remove(temp_file)
-    
-    if password_check == True:
+        #Instant decoding, kept in memory instead of going through a temp file
         try:
-            output_text_file = filedialog.asksaveasfilename(
-                title="Save the decoded text as", 
-                defaultextension=info_type.decode("utf-8"))
-            save_check = True
-        except:
-            tkMessageBox.showerror('Operation cancelled by user')
-            save_check = False
-            remove(temp_file)
-
-    #Saving the decoded text
-    if save_check == True:
+            ciphertext = LSBSteg.recover_message_from_image(Image.open(image), 3)
+        except (OSError, IndexError, ValueError):
+            raise StegError("No information detected in the image")
+
+        #Decrypting using the information, a failed tag check comes back as None
         try:
-            Path(output_text_file).write_text(unencrypted_text)
-            remove(temp_file)
-            tkMessageBox.showinfo(message="Extraction complete")
-        except:
-            tkMessageBox.showerror(message="Extraction Error")
+            decrypted = aead_decrypt(
+                key, nonce, passphrase.encode("utf-8"), ciphertext, variant)
+        except RuntimeError as error:
+            raise StegError(str(error))
+    finally:
+        #The key is no longer needed once the tag has been checked
+        wipe(key)
+    if decrypted is None:
+        raise StegError("Invalid Password")
+
+    #Saving the decoded text exactly as it was embedded, no decode/encode round trip
+    try:
+        write_atomically(output_text_file, decrypted)
+    except OSError:
+        raise StegError("Extraction Error")
 
 #The encoding process
 def encoding():
     text_file_check = False
     text_file = filedialog.askopenfilename(title = "Select a text file",
-     filetypes=[('Text files', [".txt"])])
+     filetypes=TEXT_FILETYPES)
     
+    info_file_type = Path(text_file).suffix.lower()
     if text_file == '':
         tkMessageBox.showerror(message='No text file selected')
-    elif Path(text_file).suffix != ".txt":
+    elif info_file_type not in TEXT_EXTS:
         tkMessageBox.showerror(message='Invalid file format')
     else:
-        info_file_type = Path(text_file).suffix
         text_file_check = True
 
     if text_file_check == True:
         image_file = filedialog.askopenfilename(
             title = "Select an image", 
-            filetypes=[("Image files", ["*.png", "*.jpg", ".jpeg"])])
+            filetypes=IMAGE_FILETYPES)
         if image_file == '':
             tkMessageBox.showerror(message='No image selected')
-        elif Path(image_file).suffix not in [".png", ".jpg", ".jpeg"]:
+        elif Path(image_file).suffix.lower() not in IMAGE_EXTS:
             tkMessageBox.showerror(message="Invalid image format")
         else:
-            embed_text_in_image(text_file, image_file, info_file_type)
+            return collect_embed_outputs(text_file, image_file, info_file_type)
+
+#Asking for the passphrase and both output paths before any work starts
+def collect_embed_outputs(text_file, image_file, info_file_type):
+    '''
+    Returns a job that runs embed_text_in_image with no further dialogs,
+    or None if the user backs out. The caller decides which thread runs it.
+    '''
+    dialog = customtk.CTkInputDialog(
+        text='Input a passphrase:', 
+        title="Passphrase")
+    passphrase = dialog.get_input()
+    if not passphrase:
+        tkMessageBox.showerror(message='Passphrase required')
+        return None
+
+    output_image = filedialog.asksaveasfilename(
+        title = "Save output image as", 
+        defaultextension=".png")
+    if output_image == '':
+        tkMessageBox.showerror(message="Operation cancelled by user")
+        return None
+
+    key_file = filedialog.asksaveasfilename(
+        title = "Save the key as", 
+        defaultextension=".bin")
+    if key_file == '':
+        tkMessageBox.showerror(message="Operation cancelled by user")
+        return None
+
+    return partial(
+        embed_text_in_image, 
+        text_file, image_file, info_file_type, passphrase, output_image, key_file)
     
 
 #The decoding process
@@ -193,11 +333,11 @@ def decoding():
     encrypted_image_check = False
     encrypted_image = filedialog.askopenfilename(
         title="Select the encoded image", 
-        filetypes=[("Image files", "*.png")])
+        filetypes=STEGO_IMAGE_FILETYPES)
    
     if encrypted_image == '':
         tkMessageBox.showerror(message="No image selected")
-    elif Path(encrypted_image).suffix not in [".png"]:
+    elif Path(encrypted_image).suffix.lower() not in STEGO_IMAGE_EXTS:
         tkMessageBox.showerror(message="Invalid image format")
     else:
         encrypted_image_check = True
@@ -205,10 +345,47 @@ def decoding():
     if encrypted_image_check == True:
         authentication = filedialog.askopenfilename(
             title="Select the authentication file",
-            filetypes=[("Binary files", "*.bin")])
+            filetypes=KEY_FILETYPES)
         if authentication == '':
             tkMessageBox.showerror(message='No authentication file selected')
-        elif Path(authentication).suffix not in [".bin"]:
+        elif Path(authentication).suffix.lower() not in KEY_FILE_EXTS:
             tkMessageBox.showerror(message="Invalid authentication file")
         else:
-            extract_text_in_image(encrypted_image, authentication)
+            return collect_extract_inputs(encrypted_image, authentication)
+
+#Reading the key file and asking for the passphrase and output path before any work starts
+def collect_extract_inputs(encrypted_image, authentication):
+    '''
+    Returns a job that runs extract_text_in_image with no further dialogs,
+    or None if the user backs out. The caller decides which thread runs it.
+    '''
+    #Getting necessary info, the key file is tiny so reading it here is fine
+    try:
+        unlock_info = read_key_file(authentication)
+    except OSError:
+        unlock_info = None
+    if unlock_info is None:
+        tkMessageBox.showerror(message="Invalid authentication file")
+        return None
+    key, nonce, info_type, variant = unlock_info
+
+    dialog = customtk.CTkInputDialog(
+        text='Input the passphrase:', 
+        title="Passphrase")
+    passphrase = dialog.get_input()
+    if not passphrase:
+        tkMessageBox.showerror(message='Passphrase required')
+        wipe(key)
+        return None
+
+    output_text_file = filedialog.asksaveasfilename(
+        title="Save the decoded text as", 
+        defaultextension=info_type)
+    if output_text_file == '':
+        tkMessageBox.showerror(message='Operation cancelled by user')
+        wipe(key)
+        return None
+
+    return partial(
+        extract_text_in_image, 
+        encrypted_image, key, nonce, variant, passphrase, output_text_file)